@@ -2,18 +2,108 @@
 Setup command handlers for WASM - initial setup, completions, permissions, and doctor.
 """
 
+import errno
+import functools
 import os
+import stat
 import sys
 import shutil
+import traceback
 from argparse import Namespace
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from wasm.core.logger import Logger
 from wasm.core.exceptions import WASMError
 from wasm.core.config import DEFAULT_APPS_DIR, DEFAULT_LOG_DIR, DEFAULT_CONFIG_PATH
 from wasm.core.utils import command_exists, run_command, run_command_sudo, run_trusted_installer
 
+# Completion scripts ship inside the package (cli/commands/ -> wasm/completions/)
+_COMPLETIONS_DIR = Path(__file__).resolve().parent.parent.parent / "completions"
+_BASH_SRC = _COMPLETIONS_DIR / "wasm.bash"
+_ZSH_SRC = _COMPLETIONS_DIR / "_wasm"
+_FISH_SRC = _COMPLETIONS_DIR / "wasm.fish"
+
+
+@functools.lru_cache(maxsize=1)
+def _home() -> Path:
+    """
+    Home directory of the invoking user (cached).
+    
+    Resolved on first use rather than at import, since Path.home() raises
+    when $HOME is unset and the uid has no passwd entry.
+    """
+    return Path.home()
+
+
+@dataclass(frozen=True)
+class _ShellCompletion:
+    """Where a shell's completion script comes from and where it goes."""
+    
+    name: str
+    source: Path
+    filename: str
+    user_subdir: str
+    system_dirs: Tuple[Path, ...]
+    hints: Tuple[str, ...] = ()
+    user_hints: Tuple[str, ...] = ()
+    
+    @property
+    def user_dir(self) -> Path:
+        """User-local target directory (for --user-only)."""
+        return _home() / self.user_subdir
+
+
+_SHELL_COMPLETIONS: Dict[str, _ShellCompletion] = {
+    "bash": _ShellCompletion(
+        name="bash",
+        source=_BASH_SRC,
+        filename="wasm",
+        user_subdir=".local/share/bash-completion/completions",
+        system_dirs=(Path("/etc/bash_completion.d"),),
+        hints=("Restart your shell or run: source ~/.bashrc",),
+    ),
+    "zsh": _ShellCompletion(
+        name="zsh",
+        source=_ZSH_SRC,
+        filename="_wasm",
+        user_subdir=".zsh/completions",
+        system_dirs=(
+            Path("/usr/share/zsh/site-functions"),
+            Path("/usr/local/share/zsh/site-functions"),
+        ),
+        hints=("Run: autoload -Uz compinit && compinit",),
+        user_hints=("Add to .zshrc: fpath=(~/.zsh/completions $fpath)",),
+    ),
+    "fish": _ShellCompletion(
+        name="fish",
+        source=_FISH_SRC,
+        filename="wasm.fish",
+        user_subdir=".config/fish/completions",
+        system_dirs=(Path("/usr/share/fish/vendor_completions.d"),),
+        hints=("Completions should work immediately or run: exec fish",),
+    ),
+}
+
+# os.link() failures that mean "copy instead": cross-device, disallowed
+# (e.g. fs.protected_hardlinks), too many links, or unsupported by the fs
+_LINK_FALLBACK_ERRNOS = frozenset((errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP))
+
+# Directories created by `wasm setup init`: (label, path, mode)
+_INIT_DIRS = (
+    ("apps", DEFAULT_APPS_DIR, 0o755),
+    ("log", DEFAULT_LOG_DIR, 0o755),
+    ("config", DEFAULT_CONFIG_PATH.parent, 0o755),
+)
+
+# System directories probed by `wasm setup permissions`: (label, path)
+_SYSTEM_DIRS = (
+    ("Nginx sites-available", Path("/etc/nginx/sites-available")),
+    ("Systemd directory", Path("/etc/systemd/system")),
+)
+
 
 def handle_setup(args: Namespace) -> int:
     """
@@ -26,38 +116,35 @@ def handle_setup(args: Namespace) -> int:
         Exit code.
     """
     action = args.action
-    
-    handlers = {
-        "completions": _handle_completions,
-        "init": _handle_init,
-        "permissions": _handle_permissions,
-        "ssh": _handle_ssh,
-        "doctor": _handle_doctor,
-    }
-    
-    handler = handlers.get(action)
-    if not handler:
-        print(f"Unknown action: {action}", file=sys.stderr)
-        return 1
+    logger = Logger(verbose=args.verbose)
     
     try:
-        return handler(args)
+        match action:
+            case "completions":
+                return _handle_completions(args, logger)
+            case "init":
+                return _handle_init(args, logger)
+            case "permissions":
+                return _handle_permissions(args, logger)
+            case "ssh":
+                return _handle_ssh(args, logger)
+            case "doctor":
+                return _handle_doctor(args, logger)
+            case _:
+                print(f"Unknown action: {action}", file=sys.stderr)
+                return 1
     except WASMError as e:
-        logger = Logger(verbose=args.verbose)
         logger.error(str(e))
         return 1
     except Exception as e:
-        logger = Logger(verbose=args.verbose)
         logger.error(f"Unexpected error: {e}")
         if args.verbose:
-            import traceback
             traceback.print_exc()
         return 1
 
 
-def _handle_completions(args: Namespace) -> int:
+def _handle_completions(args: Namespace, logger: Logger) -> int:
     """Handle completions setup command."""
-    logger = Logger(verbose=args.verbose)
     shell = args.shell
     
     # Auto-detect shell if not specified
@@ -71,127 +158,127 @@ def _handle_completions(args: Namespace) -> int:
     logger.key_value("Shell", shell)
     logger.blank()
     
-    # Get completion script path (from cli/commands/ up to wasm/completions/)
-    completions_dir = Path(__file__).parent.parent.parent / "completions"
-    
-    if shell == "bash":
-        return _install_bash_completions(logger, completions_dir, args.user_only)
-    elif shell == "zsh":
-        return _install_zsh_completions(logger, completions_dir, args.user_only)
-    elif shell == "fish":
-        return _install_fish_completions(logger, completions_dir, args.user_only)
-    else:
+    spec = _SHELL_COMPLETIONS.get(shell)
+    if spec is None:
         logger.error(f"Unsupported shell: {shell}")
         return 1
+    
+    return _install_completions(logger, spec, args.user_only)
 
 
+@functools.lru_cache(maxsize=1)
 def _detect_shell() -> str | None:
-    """Detect the current shell."""
-    shell_path = os.environ.get("SHELL", "")
-    if "bash" in shell_path:
-        return "bash"
-    elif "zsh" in shell_path:
-        return "zsh"
-    elif "fish" in shell_path:
-        return "fish"
-    return None
+    """Detect the current shell (cached; $SHELL is fixed for the process)."""
+    name = os.path.basename(os.environ.get("SHELL", ""))
+    return name if name in _SHELL_COMPLETIONS else None
 
 
-def _install_bash_completions(logger: Logger, completions_dir: Path, user_only: bool) -> int:
-    """Install bash completions."""
-    source_file = completions_dir / "wasm.bash"
-    
-    if not source_file.exists():
-        logger.error("Bash completion script not found")
-        return 1
-    
-    if user_only:
-        target_dir = Path.home() / ".local" / "share" / "bash-completion" / "completions"
-        target_file = target_dir / "wasm"
-    else:
-        target_dir = Path("/etc/bash_completion.d")
-        target_file = target_dir / "wasm"
-        
-        if os.geteuid() != 0:
-            logger.error("System-wide installation requires root privileges")
-            logger.info("Use --user-only for user-local installation, or run with sudo")
-            return 1
-    
+@contextmanager
+def _umask(mask: int) -> Iterator[None]:
+    """Temporarily set the process umask."""
+    old = os.umask(mask)
     try:
-        target_dir.mkdir(parents=True, exist_ok=True)
-        shutil.copy(source_file, target_file)
-        logger.success(f"Installed bash completions to {target_file}")
-        logger.info("Restart your shell or run: source ~/.bashrc")
-        return 0
-    except PermissionError:
-        logger.error(f"Permission denied writing to {target_file}")
-        logger.info("Try running with sudo or use --user-only")
-        return 1
+        yield
+    finally:
+        os.umask(old)
 
 
-def _install_zsh_completions(logger: Logger, completions_dir: Path, user_only: bool) -> int:
-    """Install zsh completions."""
-    source_file = completions_dir / "_wasm"
+def _install_file(src: Path, dst: Path, mode: int = 0o644, allow_link: bool = False) -> None:
+    """
+    Put a file into place with the given mode, install(1)-style.
     
-    if not source_file.exists():
-        logger.error("Zsh completion script not found")
-        return 1
+    With allow_link, hardlinks src to dst when both live on the same
+    filesystem and src is owned by the caller with exactly the requested
+    mode. Otherwise copies with shutil.copyfile() and sets the mode.
     
-    if user_only:
-        target_dir = Path.home() / ".zsh" / "completions"
-        target_file = target_dir / "_wasm"
-        fpath_hint = 'Add to .zshrc: fpath=(~/.zsh/completions $fpath)'
-    else:
-        target_dir = Path("/usr/share/zsh/site-functions")
-        if not target_dir.exists():
-            target_dir = Path("/usr/local/share/zsh/site-functions")
-        target_file = target_dir / "_wasm"
-        fpath_hint = None
-        
-        if os.geteuid() != 0:
-            logger.error("System-wide installation requires root privileges")
-            logger.info("Use --user-only for user-local installation, or run with sudo")
-            return 1
+    Args:
+        src: Source file.
+        dst: Destination file (overwritten if it exists).
+        mode: Permission bits for the destination.
+        allow_link: Allow a hardlink instead of a copy. Never set this for
+            system-wide installs: dst would share src's inode and owner.
+    
+    Note:
+        A hardlinked dst is the same file as src, so editing dst in place
+        also edits the packaged script (in site-packages, or the checkout
+        for editable installs). A copy never had that effect.
+    """
+    src_st = os.stat(src)
+    linkable = (
+        allow_link
+        and src_st.st_uid == os.geteuid()
+        and stat.S_IMODE(src_st.st_mode) == mode
+    )
+    
+    if dst.exists() and os.path.samefile(src, dst):
+        if linkable:
+            return
+        # Break a link left by an earlier install; copying onto it would
+        # truncate src.
+        dst.unlink()
     
+    if linkable:
+        try:
+            _link_file(src, dst)
+            return
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+    
+    # shutil.copyfile() already uses os.sendfile() on Linux and falls back
+    # to a read/write loop where the filesystem or platform rejects it.
+    shutil.copyfile(src, dst)
+    os.chmod(dst, mode)
+
+
+def _link_file(src: Path, dst: Path) -> None:
+    """Atomically replace dst with a hardlink to src."""
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    # Clear a leftover from a crashed run, which would make link() fail
+    tmp.unlink(missing_ok=True)
+    os.link(src, tmp)
     try:
-        target_dir.mkdir(parents=True, exist_ok=True)
-        shutil.copy(source_file, target_file)
-        logger.success(f"Installed zsh completions to {target_file}")
-        if fpath_hint:
-            logger.info(fpath_hint)
-        logger.info("Run: autoload -Uz compinit && compinit")
-        return 0
-    except PermissionError:
-        logger.error(f"Permission denied writing to {target_file}")
-        logger.info("Try running with sudo or use --user-only")
-        return 1
+        os.replace(tmp, dst)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+        raise
 
 
-def _install_fish_completions(logger: Logger, completions_dir: Path, user_only: bool) -> int:
-    """Install fish completions."""
-    source_file = completions_dir / "wasm.fish"
-    
-    if not source_file.exists():
-        logger.error("Fish completion script not found")
+def _install_completions(logger: Logger, spec: _ShellCompletion, user_only: bool) -> int:
+    """Install completions for one shell as described by its spec."""
+    if not spec.source.exists():
+        logger.error(f"{spec.name.capitalize()} completion script not found")
         return 1
     
     if user_only:
-        target_dir = Path.home() / ".config" / "fish" / "completions"
-        target_file = target_dir / "wasm.fish"
+        try:
+            target_dir = spec.user_dir
+        except (RuntimeError, KeyError) as e:
+            logger.error(f"Cannot install user-local completions: {e}")
+            logger.info("Set $HOME, or run with sudo for a system-wide installation")
+            return 1
+        hints = spec.user_hints + spec.hints
     else:
-        target_dir = Path("/usr/share/fish/vendor_completions.d")
-        target_file = target_dir / "wasm.fish"
+        # First existing candidate wins; otherwise create the last one
+        target_dir = next((d for d in spec.system_dirs if d.exists()), spec.system_dirs[-1])
+        hints = spec.hints
         
         if os.geteuid() != 0:
             logger.error("System-wide installation requires root privileges")
             logger.info("Use --user-only for user-local installation, or run with sudo")
             return 1
     
+    target_file = target_dir / spec.filename
+    
     try:
-        target_dir.mkdir(parents=True, exist_ok=True)
-        shutil.copy(source_file, target_file)
-        logger.success(f"Installed fish completions to {target_file}")
-        logger.info("Completions should work immediately or run: exec fish")
+        # System-wide installs pin the umask so the directories are world-readable
+        # whatever the caller's umask; user installs keep it for any new ~ parents.
+        with nullcontext() if user_only else _umask(0o022):
+            os.makedirs(target_dir, mode=0o755, exist_ok=True)
+            _install_file(spec.source, target_file, allow_link=user_only)
+        logger.success(f"Installed {spec.name} completions to {target_file}")
+        for hint in hints:
+            logger.info(hint)
         return 0
     except PermissionError:
         logger.error(f"Permission denied writing to {target_file}")
@@ -199,7 +286,7 @@ def _install_fish_completions(logger: Logger, completions_dir: Path, user_only:
         return 1
 
 
-def _handle_init(args: Namespace) -> int:
+def _handle_init(args: Namespace, logger: Logger) -> int:
     """
     Handle initial system setup - comprehensive guided wizard.
     
@@ -211,8 +298,6 @@ def _handle_init(args: Namespace) -> int:
     5. SSL configuration
     6. Configuration file creation
     """
-    logger = Logger(verbose=args.verbose)
-    
     # Check for root
     if os.geteuid() != 0:
         logger.error("Initial setup requires root privileges")
@@ -413,33 +498,16 @@ def _handle_init(args: Namespace) -> int:
     # =========================================================================
     logger.step(5, 6, "Creating WASM directories")
     
-    # Create apps directory
-    logger.substep(f"Creating apps directory: {DEFAULT_APPS_DIR}")
-    try:
-        DEFAULT_APPS_DIR.mkdir(parents=True, exist_ok=True)
-        os.chmod(DEFAULT_APPS_DIR, 0o755)
-        logger.success(f"Created {DEFAULT_APPS_DIR}")
-    except Exception as e:
-        logger.warning(f"Failed to create apps directory: {e}")
-    
-    # Create log directory
-    logger.substep(f"Creating log directory: {DEFAULT_LOG_DIR}")
-    try:
-        DEFAULT_LOG_DIR.mkdir(parents=True, exist_ok=True)
-        os.chmod(DEFAULT_LOG_DIR, 0o755)
-        logger.success(f"Created {DEFAULT_LOG_DIR}")
-    except Exception as e:
-        logger.warning(f"Failed to create log directory: {e}")
-    
-    # Create config directory
-    config_dir = DEFAULT_CONFIG_PATH.parent
-    logger.substep(f"Creating config directory: {config_dir}")
-    try:
-        config_dir.mkdir(parents=True, exist_ok=True)
-        os.chmod(config_dir, 0o755)
-        logger.success(f"Created {config_dir}")
-    except Exception as e:
-        logger.warning(f"Failed to create config directory: {e}")
+    for label, path, mode in _INIT_DIRS:
+        logger.substep(f"Creating {label} directory: {path}")
+        try:
+            os.makedirs(path, mode=mode, exist_ok=True)
+            # Re-runs usually find the mode already correct; skip the chmod then
+            if stat.S_IMODE(os.stat(path).st_mode) != mode:
+                os.chmod(path, mode)
+            logger.success(f"Created {path}")
+        except Exception as e:
+            logger.warning(f"Failed to create {label} directory: {e}")
     
     # =========================================================================
     # Phase 6: Create/Update Configuration File
@@ -667,10 +735,8 @@ def _interactive_setup_prompts(
         return None
 
 
-def _handle_permissions(args: Namespace) -> int:
+def _handle_permissions(args: Namespace, logger: Logger) -> int:
     """Handle permissions check and fix."""
-    logger = Logger(verbose=args.verbose)
-    
     logger.header("WASM Permissions Check")
     logger.blank()
     
@@ -707,21 +773,14 @@ def _handle_permissions(args: Namespace) -> int:
             logger.warning(f"Config directory not readable: {config_dir}")
             issues.append(("config_dir", config_dir))
     
-    # Check nginx/apache access
-    nginx_available = Path("/etc/nginx/sites-available")
-    if nginx_available.exists():
-        if os.access(nginx_available, os.W_OK):
-            logger.success(f"Nginx sites-available writable")
-        else:
-            logger.info(f"Nginx sites-available requires sudo")
-    
-    # Check systemd access
-    systemd_dir = Path("/etc/systemd/system")
-    if systemd_dir.exists():
-        if os.access(systemd_dir, os.W_OK):
-            logger.success(f"Systemd directory writable")
+    # Check nginx/systemd access
+    for label, path in _SYSTEM_DIRS:
+        if not path.exists():
+            continue
+        if os.access(path, os.W_OK):
+            logger.success(f"{label} writable")
         else:
-            logger.info(f"Systemd directory requires sudo")
+            logger.info(f"{label} requires sudo")
     
     logger.blank()
     
@@ -735,7 +794,7 @@ def _handle_permissions(args: Namespace) -> int:
     return 0
 
 
-def _handle_ssh(args: Namespace) -> int:
+def _handle_ssh(args: Namespace, logger: Logger) -> int:
     """Handle SSH key setup and verification."""
     import os
     from wasm.validators.ssh import (
@@ -747,8 +806,6 @@ def _handle_ssh(args: Namespace) -> int:
         get_all_ssh_keys,
     )
     
-    logger = Logger(verbose=args.verbose)
-    
     logger.header("WASM SSH Setup")
     logger.blank()
     
@@ -855,15 +912,13 @@ def _handle_ssh(args: Namespace) -> int:
     return 0
 
 
-def _handle_doctor(args: Namespace) -> int:
+def _handle_doctor(args: Namespace, logger: Logger) -> int:
     """
     Handle doctor command - comprehensive system diagnostics.
     
     Checks all dependencies, configurations, and provides actionable
     recommendations to fix any issues.
     """
-    logger = Logger(verbose=args.verbose)
-    
     logger.header("WASM System Diagnostics")
     logger.blank()
     